@@ -6,16 +6,14 @@
 
 from __future__ import annotations
 import pathlib
-import json
 import struct
 import operator
 import logging
 from asyncio import Future, Task
-from io import BytesIO
 from functools import reduce
 from threading import Lock as ThreadLock
 import lmdb
-from utils import SentinelClass, ServerError
+from utils import SentinelClass, ServerError, json_encode, json_loads
 
 # Annotation imports
 from typing import (
@@ -48,8 +46,8 @@ RECORD_ENCODE_FUNCS = {
     float: lambda x: b"d" + struct.pack("d", x),
     bool: lambda x: b"?" + struct.pack("?", x),
     str: lambda x: b"s" + x.encode(),
-    list: lambda x: json.dumps(x).encode(),
-    dict: lambda x: json.dumps(x).encode(),
+    list: lambda x: json_encode(x),
+    dict: lambda x: json_encode(x),
 }
 
 RECORD_DECODE_FUNCS = {
@@ -57,8 +55,8 @@ RECORD_DECODE_FUNCS = {
     ord("d"): lambda x: struct.unpack("d", x[1:])[0],
     ord("?"): lambda x: struct.unpack("?", x[1:])[0],
     ord("s"): lambda x: bytes(x[1:]).decode(),
-    ord("["): lambda x: json.load(BytesIO(x)),
-    ord("{"): lambda x: json.load(BytesIO(x)),
+    ord("["): lambda x: json_loads(bytes(x)),
+    ord("{"): lambda x: json_loads(bytes(x)),
 }
 
 SENTINEL = SentinelClass.get_instance()
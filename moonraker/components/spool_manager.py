@@ -0,0 +1,487 @@
+# Filament spool tracking
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+from __future__ import annotations
+import logging
+import math
+import time
+from asyncio import Lock
+
+# Annotation imports
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Optional,
+    Tuple,
+    Dict,
+    List,
+)
+if TYPE_CHECKING:
+    from confighelper import ConfigHelper
+    from websockets import WebRequest
+    from .database import MoonrakerDatabase as DBComp
+    from .database import NamespaceWrapper
+    from .klippy_apis import KlippyAPI
+
+SPOOL_NAMESPACE = "spool_manager"
+ACTIVE_SPOOL_KEY = "spool_manager.active_spool_id"
+NEXT_SPOOL_ID_KEY = "spool_manager.next_spool_id"
+MATERIALS_PREFIX = "spool_manager material"
+MAX_SPOOLS = 1000
+TRACK_FLUSH_INTERVAL = 2.
+# Minimum accumulated extrusion worth a database write, in microns
+MIN_FLUSH_DELTA_UM = 1000
+
+def _augment_spool_record(data: Dict[str, Any]) -> Dict[str, Any]:
+    diameter = data.get('diameter')
+    density = data.get('density')
+    used_weight = 0.
+    if diameter and density:
+        used_weight = math.pi * (diameter / 2.)**2 \
+            * (density / 1000.) * data.get('used_length', 0.)
+    return {**data, 'used_weight': used_weight}
+
+class Validation:
+    __slots__ = ()
+    _required_attributes: Tuple[str, ...] = ()
+
+    def validate(self) -> Tuple[str, ...]:
+        return tuple(f for f in self._required_attributes
+                     if getattr(self, f) is None)
+
+class Spool(Validation):
+    # Up to MAX_SPOOLS instances may be materialized at once, slots
+    # keep the per-instance footprint down and drive serialization
+    __slots__ = (
+        'name', 'color', 'vendor', 'material', 'density', 'diameter',
+        'total_weight', 'spool_weight', 'used_length', 'first_used',
+        'last_used', 'cost', 'comment', 'active', '_weight_per_mm'
+    )
+    _required_attributes = ('name', 'material', 'density', 'diameter')
+    _valid_attributes = frozenset(__slots__)
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.name: Optional[str] = None
+        self.color: Optional[str] = None
+        self.vendor: Optional[str] = None
+        self.material: Optional[str] = None
+        self.density: Optional[float] = None
+        self.diameter: Optional[float] = None
+        self.total_weight: Optional[float] = None
+        self.spool_weight: Optional[float] = None
+        self.used_length: float = 0.
+        self.first_used: Optional[float] = None
+        self.last_used: Optional[float] = None
+        self.cost: Optional[float] = None
+        self.comment: Optional[str] = None
+        self.active: bool = True
+        self._weight_per_mm: float = 0.
+        self.update(data)
+
+    def update(self, data: Dict[str, Any]) -> None:
+        for a in data.keys() & self._valid_attributes:
+            setattr(self, a, data[a])
+        # Diameter and density are invariant between updates, so the
+        # grams extruded per mm of filament can be computed up front.
+        # Density is in g/cm^3, lengths are in mm.
+        if self.diameter and self.density:
+            self._weight_per_mm = math.pi * (self.diameter / 2.)**2 \
+                * (self.density / 1000.)
+        else:
+            self._weight_per_mm = 0.
+
+    def used_weight(self) -> float:
+        # _weight_per_mm is zero when diameter or density is unset,
+        # so the multiply is always safe
+        return self.used_length * self._weight_per_mm
+
+    def serialize(self, include_calculated: bool = False) -> Dict[str, Any]:
+        data = {s: getattr(self, s) for s in self.__slots__
+                if not s.startswith('_')}
+        if include_calculated:
+            data['used_weight'] = self.used_weight()
+        return data
+
+class SpoolManager:
+    def __init__(self,
+                 config: ConfigHelper,
+                 handler: SpoolManagerHandler
+                 ) -> None:
+        self.server = config.get_server()
+        self.handler = handler
+        database: DBComp = self.server.lookup_component("database")
+        database.register_local_namespace(SPOOL_NAMESPACE)
+        self.db: NamespaceWrapper = database.wrap_namespace(
+            SPOOL_NAMESPACE, parse_keys=False)
+        self.moonraker_db: NamespaceWrapper = database.wrap_namespace(
+            "moonraker")
+        self.materials = self._parse_materials_cfg(config)
+        # Cache the active spool and its raw record to keep repeated
+        # filament tracking events from hitting the database
+        self._active_spool_cache: Optional[
+            Tuple[str, Spool, Dict[str, Any]]] = None
+        # The active spool id is read once at startup and maintained
+        # in-process, writes to the database pass through the cache
+        self._active_spool_id: Optional[str] = None
+
+    async def component_init(self) -> None:
+        self._active_spool_id = await self.moonraker_db.get(
+            ACTIVE_SPOOL_KEY, None)
+
+    def _parse_materials_cfg(self,
+                             config: ConfigHelper
+                             ) -> Dict[str, Dict[str, Any]]:
+        materials = dict(
+            self._parse_material_section(config, section)
+            for section in config.get_prefix_sections(MATERIALS_PREFIX)
+        )
+        logging.debug("Configured materials: %s", materials)
+        return materials
+
+    def _parse_material_section(self,
+                                config: ConfigHelper,
+                                section: str
+                                ) -> Tuple[str, Dict[str, Any]]:
+        name = section[len(MATERIALS_PREFIX):].strip()
+        if not name:
+            raise config.error(
+                f"Invalid material section [{section}], no name")
+        cfg = config.getsection(section)
+        return name, {
+            'density': cfg.getfloat('density', above=0.),
+            'diameter': cfg.getfloat('diameter', 1.75, above=0.)
+        }
+
+    def _apply_material_defaults(self,
+                                 data: Dict[str, Any]
+                                 ) -> Dict[str, Any]:
+        material = data.get('material')
+        if material is not None and material in self.materials:
+            for field, value in self.materials[material].items():
+                data.setdefault(field, value)
+        return data
+
+    async def _next_spool_id(self) -> int:
+        next_spool_id: Optional[int] = await self.moonraker_db.get(
+            NEXT_SPOOL_ID_KEY, None)
+        if next_spool_id is None:
+            # Bootstrap the counter from databases created before
+            # it was introduced
+            spools = await self.db.keys()
+            next_spool_id = int(spools[-1], 16) + 1 if spools else 0
+        return next_spool_id
+
+    async def add_spool(self, data: Dict[str, Any]) -> str:
+        spool = Spool(self._apply_material_defaults(data))
+        missing = spool.validate()
+        if missing:
+            raise self.server.error(
+                f"Missing required spool attributes: {', '.join(missing)}")
+        if await self.db.length() >= MAX_SPOOLS:
+            raise self.server.error(
+                f"Cannot add spool, maximum of {MAX_SPOOLS} "
+                "spools reached")
+        next_spool_id = await self._next_spool_id()
+        self.moonraker_db[NEXT_SPOOL_ID_KEY] = next_spool_id + 1
+        spool_id = f"{next_spool_id:06X}"
+        self.db[spool_id] = spool.serialize()
+        return spool_id
+
+    async def bulk_update(self, items: List[Dict[str, Any]]) -> List[str]:
+        # Fetch the current records once, merge the requested changes
+        # in memory and write the result back in a single transaction
+        current = dict(await self.db.items())
+        pending: Dict[str, Any] = {}
+        ids: List[str] = []
+        next_spool_id: Optional[int] = None
+        new_spools = 0
+        for data in items:
+            data = dict(data)
+            spool_id: Optional[str] = data.pop('id', None)
+            if spool_id is None:
+                if len(current) + new_spools >= MAX_SPOOLS:
+                    raise self.server.error(
+                        f"Cannot add spool, maximum of {MAX_SPOOLS} "
+                        "spools reached")
+                if next_spool_id is None:
+                    next_spool_id = await self._next_spool_id()
+                spool_id = f"{next_spool_id:06X}"
+                next_spool_id += 1
+                new_spools += 1
+                spool = Spool(self._apply_material_defaults(data))
+            else:
+                record = pending.get(spool_id, current.get(spool_id))
+                if record is None:
+                    raise self.server.error(
+                        f"Spool id {spool_id} not found", 404)
+                spool = Spool(record)
+                spool.update(data)
+            missing = spool.validate()
+            if missing:
+                raise self.server.error(
+                    f"Missing required spool attributes: {', '.join(missing)}")
+            cached = self._active_spool_cache
+            if cached is not None and cached[0] == spool_id:
+                self._active_spool_cache = None
+            pending[spool_id] = spool.serialize()
+            ids.append(spool_id)
+        if next_spool_id is not None:
+            self.moonraker_db[NEXT_SPOOL_ID_KEY] = next_spool_id
+        if pending:
+            await self.db.insert_batch(pending)
+        return ids
+
+    async def update_spool(self, spool_id: str, data: Dict[str, Any]) -> None:
+        spool = await self.find_spool(spool_id)
+        if spool is None:
+            raise self.server.error(f"Spool id {spool_id} not found", 404)
+        spool.update(data)
+        missing = spool.validate()
+        if missing:
+            raise self.server.error(
+                f"Missing required spool attributes: {', '.join(missing)}")
+        cached = self._active_spool_cache
+        if cached is not None and cached[0] == spool_id:
+            self._active_spool_cache = None
+        self.db[spool_id] = spool.serialize()
+
+    async def delete_spool(self, spool_id: str) -> None:
+        cached = self._active_spool_cache
+        if cached is not None and cached[0] == spool_id:
+            self._active_spool_cache = None
+        await self.db.delete(spool_id)
+        if spool_id == self._active_spool_id:
+            # The active spool no longer exists, deactivate tracking
+            # rather than leaving the active id pointing at a dead
+            # record
+            self._active_spool_id = None
+            self.moonraker_db[ACTIVE_SPOOL_KEY] = None
+
+    async def find_spool(self, spool_id: str) -> Optional[Spool]:
+        data = await self.db.get(spool_id, None)
+        if data is None:
+            return None
+        return Spool(data)
+
+    async def find_all_spools(self,
+                              show_inactive: bool = False
+                              ) -> Dict[str, Any]:
+        # Stored records are serialized spools, so inactive entries
+        # can be filtered and the used weight calculated without
+        # constructing a Spool for each record
+        return {
+            spool_id: _augment_spool_record(data)
+            for spool_id, data in await self.db.items()
+            if show_inactive or data.get('active')
+        }
+
+    def get_active_spool_id(self) -> Optional[str]:
+        return self._active_spool_id
+
+    async def set_active_spool(self, spool_id: Optional[str]) -> bool:
+        # Flush pending usage so it is tracked against the
+        # previously active spool
+        await self.track_filament_usage()
+        if spool_id is not None and not await self.db.contains(spool_id):
+            # Only existence matters here, there is no need to fetch
+            # the record and construct a Spool from it
+            return False
+        self._active_spool_cache = None
+        self._active_spool_id = spool_id
+        self.moonraker_db[ACTIVE_SPOOL_KEY] = spool_id
+        return True
+
+    async def _get_active_spool_cached(
+        self
+    ) -> Optional[Tuple[str, Spool, Dict[str, Any]]]:
+        if self._active_spool_cache is not None:
+            return self._active_spool_cache
+        spool_id = self.get_active_spool_id()
+        if spool_id is None:
+            return None
+        record = await self.db.get(spool_id, None)
+        if record is None:
+            return None
+        self._active_spool_cache = (spool_id, Spool(record), record)
+        return self._active_spool_cache
+
+    async def track_filament_usage(self) -> None:
+        async with self.handler.extrusion_lock:
+            await self._track_usage_locked()
+
+    async def _track_usage_locked(self) -> None:
+        extruded_um = self.handler.extruded_um
+        if extruded_um <= 0:
+            # Nothing to track, don't touch the database
+            return
+        active = await self._get_active_spool_cached()
+        if active is None:
+            # Discard extrusion that accumulated with no usable active
+            # spool, otherwise it would be charged wholesale to the
+            # next spool activated
+            self.handler.extruded_um = 0
+            return
+        spool_id, spool, record = active
+        extruded = extruded_um / 1000.
+        spool.used_length += extruded
+        used_weight = spool.used_length * spool._weight_per_mm
+        now = time.time()
+        spool.first_used = spool.first_used or now
+        spool.last_used = now
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(
+                "Tracking filament usage for spool %s: name: %s, "
+                "material: %s, extruded: %s, used length: %s, "
+                "used weight: %s, first used: %s, last used: %s",
+                spool_id, spool.name, spool.material, extruded,
+                spool.used_length, used_weight, spool.first_used,
+                spool.last_used)
+        # Only usage fields change on this path, update the cached
+        # record in place rather than re-serializing the spool
+        record['used_length'] = spool.used_length
+        record['first_used'] = spool.first_used
+        record['last_used'] = spool.last_used
+        self.db[spool_id] = record
+        self.handler.extruded_um = 0
+
+class SpoolManagerHandler:
+    def __init__(self, config: ConfigHelper) -> None:
+        self.server = config.get_server()
+        self.eventloop = self.server.get_event_loop()
+        # Accumulate extrusion as an integer micron count, deltas
+        # from consecutive status updates are far below 1.0 and
+        # would drift if summed as floats
+        self.extruded_um: int = 0
+        self.extrusion_lock = Lock()
+        self.last_epos: float = 0.
+        self.spool_manager = SpoolManager(config, self)
+        # Coalesce tracking updates rather than writing to the
+        # database on every request and status update
+        self.flush_timer = self.eventloop.register_timer(
+            self._handle_tracking_flush)
+        self.server.register_event_handler(
+            "server:klippy_ready", self._handle_klippy_ready)
+        self.server.register_event_handler(
+            "server:klippy_disconnect", self._handle_klippy_disconnect)
+        self.server.register_event_handler(
+            "server:status_update", self._handle_status_update)
+        self.server.register_notification(
+            "spool_manager:active_spool_changed")
+        self.server.register_endpoint(
+            "/server/spool_manager/spool", ['GET', 'POST', 'DELETE'],
+            self._handle_spool_request)
+        self.server.register_endpoint(
+            "/server/spool_manager/spools", ['GET', 'POST'],
+            self._handle_spools_list)
+        self.server.register_endpoint(
+            "/server/spool_manager/active_spool", ['GET', 'POST'],
+            self._handle_active_spool)
+        self.server.register_endpoint(
+            "/server/spool_manager/materials", ['GET'],
+            self._handle_materials_list)
+
+    async def component_init(self) -> None:
+        await self.spool_manager.component_init()
+
+    async def _handle_klippy_ready(self) -> None:
+        kapis: KlippyAPI = self.server.lookup_component('klippy_apis')
+        sub: Dict[str, Optional[List[str]]] = {"toolhead": ["position"]}
+        try:
+            result = await kapis.subscribe_objects(sub)
+        except self.server.error:
+            logging.info("Error subscribing to toolhead object")
+            return
+        self.last_epos = self._e_position_from_status(result)
+        self.flush_timer.start(delay=TRACK_FLUSH_INTERVAL)
+
+    async def _handle_klippy_disconnect(self) -> None:
+        self.flush_timer.stop()
+        await self.spool_manager.track_filament_usage()
+
+    async def _handle_tracking_flush(self, eventtime: float) -> float:
+        if self.extruded_um > MIN_FLUSH_DELTA_UM:
+            await self.spool_manager.track_filament_usage()
+        return eventtime + TRACK_FLUSH_INTERVAL
+
+    def _e_position_from_status(self, status: Dict[str, Any]) -> float:
+        position: List[float] = status.get(
+            "toolhead", {}).get("position", [])
+        logging.debug("position: %s", position)
+        return position[3] if len(position) > 3 else self.last_epos
+
+    async def _handle_status_update(self, data: Dict[str, Any]) -> None:
+        if "toolhead" not in data:
+            return
+        epos = self._e_position_from_status(data)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(
+                "Epos update - last: %s, new: %s, extruded: %sum",
+                self.last_epos, epos, self.extruded_um)
+        async with self.extrusion_lock:
+            delta_um = int((epos - self.last_epos) * 1000.)
+            if delta_um > 0:
+                self.extruded_um += delta_um
+            self.last_epos = epos
+
+    async def _handle_spool_request(self,
+                                    web_request: WebRequest
+                                    ) -> Dict[str, Any]:
+        action = web_request.get_action()
+        if action == "GET":
+            spool_id = web_request.get_str("id")
+            spool = await self.spool_manager.find_spool(spool_id)
+            if spool is None:
+                raise self.server.error(
+                    f"Spool id {spool_id} not found", 404)
+            return {'spool': spool.serialize(include_calculated=True)}
+        elif action == "POST":
+            post_id: Optional[str] = web_request.get_str("id", None)
+            if post_id is None:
+                post_id = await self.spool_manager.add_spool(
+                    web_request.get_args())
+            else:
+                await self.spool_manager.update_spool(
+                    post_id, web_request.get_args())
+            return {'id': post_id}
+        else:
+            spool_id = web_request.get_str("id")
+            await self.spool_manager.delete_spool(spool_id)
+            return {'id': spool_id}
+
+    async def _handle_spools_list(self,
+                                  web_request: WebRequest
+                                  ) -> Dict[str, Any]:
+        action = web_request.get_action()
+        if action == "GET":
+            show_inactive = web_request.get_boolean("show_inactive", False)
+            spools = await self.spool_manager.find_all_spools(show_inactive)
+            return {'spools': spools}
+        spool_list: List[Dict[str, Any]] = web_request.get("spools")
+        ids = await self.spool_manager.bulk_update(spool_list)
+        return {'ids': ids}
+
+    async def _handle_active_spool(self,
+                                   web_request: WebRequest
+                                   ) -> Dict[str, Any]:
+        action = web_request.get_action()
+        if action == "GET":
+            return {'id': self.spool_manager.get_active_spool_id()}
+        spool_id = web_request.get_str("id", None)
+        if not await self.spool_manager.set_active_spool(spool_id):
+            raise self.server.error(f"Spool id {spool_id} not found", 404)
+        self.server.send_event(
+            "spool_manager:active_spool_changed", {'id': spool_id})
+        return {'id': spool_id}
+
+    async def _handle_materials_list(self,
+                                     web_request: WebRequest
+                                     ) -> Dict[str, Any]:
+        return {'materials': self.spool_manager.materials}
+
+    async def close(self) -> None:
+        self.flush_timer.stop()
+        await self.spool_manager.track_filament_usage()
+
+def load_component(config: ConfigHelper) -> SpoolManagerHandler:
+    return SpoolManagerHandler(config)
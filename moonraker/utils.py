@@ -25,11 +25,13 @@ from queue import SimpleQueue as Queue
 # Annotation imports
 from typing import (
     TYPE_CHECKING,
+    Callable,
     List,
     Optional,
     ClassVar,
     Tuple,
     Dict,
+    Union,
     Any,
 )
 
@@ -41,6 +43,27 @@ MOONRAKER_PATH = str(pathlib.Path(__file__).parent.parent.resolve())
 SYS_MOD_PATHS = glob.glob("/usr/lib/python3*/dist-packages")
 SYS_MOD_PATHS += glob.glob("/usr/lib/python3*/site-packages")
 
+# Use orjson for JSON encoding and decoding when it is available.
+# It is notably faster than the standard library for the numeric
+# heavy payloads Moonraker produces, however it remains an optional
+# dependency.
+json_loads: Callable[[Union[str, bytes, bytearray]], Any]
+try:
+    import orjson
+
+    def json_encode(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_encode(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    json_loads = json.loads
+
+def json_dumps(obj: Any) -> str:
+    return json_encode(obj).decode()
+
 class ServerError(Exception):
     def __init__(self, message: str, status_code: int = 400) -> None:
         Exception.__init__(self, message)
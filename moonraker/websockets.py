@@ -7,10 +7,9 @@
 from __future__ import annotations
 import logging
 import ipaddress
-import json
 import asyncio
 from tornado.websocket import WebSocketHandler, WebSocketClosedError
-from utils import ServerError, SentinelClass
+from utils import ServerError, SentinelClass, json_dumps, json_loads
 
 # Annotation imports
 from typing import (
@@ -168,12 +167,12 @@ class JsonRPC:
                        ) -> Optional[str]:
         response: Any = None
         try:
-            obj: Union[Dict[str, Any], List[dict]] = json.loads(data)
+            obj: Union[Dict[str, Any], List[dict]] = json_loads(data)
         except Exception:
             msg = f"{self.transport} data not json: {data}"
             logging.exception(msg)
             response = self.build_error(-32700, "Parse error")
-            return json.dumps(response)
+            return json_dumps(response)
         logging.debug(f"{self.transport} Received::{data}")
         if isinstance(obj, list):
             response = []
@@ -186,7 +185,7 @@ class JsonRPC:
         else:
             response = await self.process_object(obj, conn)
         if response is not None:
-            response = json.dumps(response)
+            response = json_dumps(response)
             logging.debug(f"{self.transport} Response::{response}")
         return response
 